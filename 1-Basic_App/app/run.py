@@ -1,14 +1,49 @@
 from skimage.io import imread,imsave
-from skimage.color import rgb2gray
 from skimage.transform import resize 
+from skimage.util import img_as_float32
+import numpy as np
 import json
+from pathlib import Path
 
 
-params=json.load(open("data/param/parameters.json","r"))
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB
+    _turbo = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    # no PyTurboJPEG or no libturbojpeg on the system, imread handles jpegs too
+    _turbo = None
 
-image=imread(params["input_directory"])
+JPEG_SUFFIXES = (".jpg", ".jpeg")
 
-grey_image=rgb2gray(image)
+
+def _read_image(path):
+    """Decode jpegs with libjpeg-turbo when it is available, anything else with imread"""
+    if _turbo is not None and path.lower().endswith(JPEG_SUFFIXES):
+        with open(path, "rb") as f:
+            data = f.read()
+        try:
+            return _turbo.decode(data, pixel_format=TJPF_RGB)
+        except OSError:
+            # CMYK/YCCK jpegs, or not a jpeg despite the suffix, imread copes
+            pass
+    return imread(path)
+
+
+GREY_COEFFS = np.array([0.2125, 0.7154, 0.0721], dtype=np.float32)
+
+
+def _rgb2gray_fast(rgb):
+    """Same luminance weights as skimage rgb2gray, done as one matmul on float32"""
+    if rgb.ndim == 2:
+        return rgb
+    return img_as_float32(rgb[..., :3]) @ GREY_COEFFS
+
+
+params=json.loads(Path("data/param/parameters.json").read_bytes())
+
+image=_read_image(params["input_directory"])
+
+grey_image=_rgb2gray_fast(image)
 
 imsave(params["output_directory"],grey_image)
 
@@ -1,5 +1,12 @@
 import os
+import threading
+import time
+import shutil
 from pathlib import Path
+from functools import lru_cache
+from urllib.parse import quote
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from flask import Flask, request, abort, jsonify, send_from_directory
 from convert_func import grey_image
 
@@ -20,37 +27,85 @@ os.makedirs(DOWNLOAD_DIRECTORY,exist_ok=True)
 
 api = Flask(__name__)
 
+# Behind nginx, set this to an internal location aliasing DOWNLOAD_DIRECTORY.
+# Downloads then only carry headers and nginx sends the file with sendfile(2).
+X_ACCEL_REDIRECT_PREFIX = os.environ.get("X_ACCEL_REDIRECT_PREFIX")
+api.config["USE_X_SENDFILE"] = bool(X_ACCEL_REDIRECT_PREFIX)
+
+# converting is CPU bound, it runs in its own process so the server process
+# keeps answering other requests meanwhile. The worker stays warm between
+# converts; if it dies (e.g. OOM) the pool is rebuilt on the next one.
+# grey_image already uses every core, and two converts at once would write
+# the same output files, hence one worker behind a lock.
+executor = None
+convert_lock = threading.Lock()
+
+
+def _convert_in_worker():
+    global executor
+    if executor is None:
+        executor = ProcessPoolExecutor(max_workers=1)
+    try:
+        executor.submit(grey_image,str(UPLOAD_DIRECTORY),str(DOWNLOAD_DIRECTORY)).result()
+    except BrokenProcessPool:
+        executor.shutdown(wait=False)
+        executor = None
+        raise
+
+
+LISTING_TTL = 1.0
+
+
+@lru_cache(maxsize=4)
+def _scan_files(directory, mtime_ns, ttl_bucket):
+    # scandir entries carry the file type, no extra stat per file
+    with os.scandir(directory) as it:
+        return sorted(e.name for e in it
+                      if e.is_file(follow_symlinks=False) and not e.name.startswith("."))
+
+
+def _list_files(directory):
+    """File names in a directory, rescanned when its mtime changes or after about a second.
+
+    Directory timestamps can be coarse (jiffies, 1 s on NFS and some bind
+    mounts), so a file created in the same tick as the cached scan keeps the
+    mtime unchanged. The time bucket bounds how long that listing stays stale.
+    """
+    return list(_scan_files(str(directory), os.stat(directory).st_mtime_ns,
+                            int(time.monotonic() / LISTING_TTL)))
+
 
 @api.route("/inputs")
 def list_input_files():
     """Endpoint to list files on the server."""
-    files = []
-    for filename in os.listdir(UPLOAD_DIRECTORY):
-        path = os.path.join(UPLOAD_DIRECTORY, filename)
-        if os.path.isfile(path):
-            files.append(filename)
-    return jsonify(files)
+    return jsonify(_list_files(UPLOAD_DIRECTORY))
 
 @api.route("/outputs")
 def list_output_files():
     """Endpoint to list files on the server."""
-    files = []
-    for filename in os.listdir(DOWNLOAD_DIRECTORY):
-        path = os.path.join(DOWNLOAD_DIRECTORY, filename)
-        if os.path.isfile(path):
-            files.append(filename)
-    return jsonify(files)
+    return jsonify(_list_files(DOWNLOAD_DIRECTORY))
 
 
 @api.route("/download/<path:path>")
 def get_file(path):
     """Download a file."""
-    return send_from_directory(DOWNLOAD_DIRECTORY, path, as_attachment=True)
+    response = send_from_directory(DOWNLOAD_DIRECTORY, path, as_attachment=True)
+    if X_ACCEL_REDIRECT_PREFIX:
+        # let nginx send the file from its internal location instead
+        del response.headers["X-Sendfile"]
+        response.headers["X-Accel-Redirect"] = X_ACCEL_REDIRECT_PREFIX.rstrip("/") + "/" + quote(path)
+    return response
 
 @api.route("/convert")
 def convert_image():
     """Convert rgb image to grey image"""
-    grey_image(UPLOAD_DIRECTORY,DOWNLOAD_DIRECTORY)
+    with convert_lock:
+        try:
+            _convert_in_worker()
+        except Exception:
+            api.logger.exception("converting failed")
+            # Return 500 INTERNAL SERVER ERROR
+            abort(500, "converting failed")
     return "Converting is done"
 
 
@@ -62,8 +117,9 @@ def post_file(filename):
         # Return 400 BAD REQUEST
         abort(400, "no subdirectories directories allowed")
 
+    # copy the body in 1 MB chunks instead of buffering it all in request.data
     with open(os.path.join(UPLOAD_DIRECTORY, filename), "wb") as fp:
-        fp.write(request.data)
+        shutil.copyfileobj(request.stream, fp, 1 << 20)
 
     # Return 201 CREATED
     return "", 201
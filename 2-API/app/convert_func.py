@@ -1,23 +1,180 @@
 from skimage.io import imread,imsave
-from skimage.color import rgb2gray
 from skimage.transform import resize 
+from skimage.util import img_as_float32
+import imageio
+import tifffile
+import numpy as np
 import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB
+    _turbo = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    # no PyTurboJPEG or no libturbojpeg on the system, imread handles jpegs too
+    _turbo = None
+
+JPEG_SUFFIXES = (".jpg", ".jpeg")
+
+
+def _read_image(path):
+    """Decode jpegs with libjpeg-turbo when it is available, anything else with imread"""
+    if _turbo is not None and path.lower().endswith(JPEG_SUFFIXES):
+        with open(path, "rb") as f:
+            data = f.read()
+        try:
+            return _turbo.decode(data, pixel_format=TJPF_RGB)
+        except OSError:
+            # CMYK/YCCK jpegs, or not a jpeg despite the suffix, imread copes
+            pass
+    return imread(path)
+
+
+GREY_COEFFS = np.array([0.2125, 0.7154, 0.0721], dtype=np.float32)
+
+
+def _rgb2gray_fast(rgb):
+    """Same luminance weights as skimage rgb2gray, done as one matmul on float32"""
+    if rgb.ndim == 2:
+        return rgb
+    return img_as_float32(rgb[..., :3]) @ GREY_COEFFS
+
+
+# GREY_COEFFS scaled by 256, so the weighted sum of u8 channels fits in u16
+GREY_COEFFS_U8 = (54, 183, 19)
+
+
+GREY_TILE_ROWS = 128
+
+
+def _rgb2gray_u8(rgb):
+    """Fixed point rgb to grey for an (H, W, C) uint8 image, output stays uint8.
+
+    Rows go through the kernel in stripes of GREY_TILE_ROWS, so the uint16
+    scratch buffers are reused and stay in cache instead of being image sized.
+    """
+    height, width = rgb.shape[:2]
+    out = np.empty((height, width), dtype=np.uint8)
+    acc = np.empty((GREY_TILE_ROWS, width), dtype=np.uint16)
+    tmp = np.empty_like(acc)
+    for i in range(0, height, GREY_TILE_ROWS):
+        stripe = rgb[i:i+GREY_TILE_ROWS]
+        a, t = acc[:len(stripe)], tmp[:len(stripe)]
+        np.multiply(stripe[..., 0], GREY_COEFFS_U8[0], out=a, dtype=np.uint16)
+        np.multiply(stripe[..., 1], GREY_COEFFS_U8[1], out=t, dtype=np.uint16)
+        a += t
+        np.multiply(stripe[..., 2], GREY_COEFFS_U8[2], out=t, dtype=np.uint16)
+        a += t
+        a += 128
+        a >>= 8
+        out[i:i+GREY_TILE_ROWS] = a
+    return out
+
+
+def _rgb2gray(rgb):
+    if rgb.ndim == 3 and rgb.dtype == np.uint8:
+        return _rgb2gray_u8(rgb)
+    return _rgb2gray_fast(rgb)
+
+
+def _output_file(path:str,output_path:str):
+    filename=os.path.basename(path)
+    output_file=filename.split(".")[0]+"_grey."+filename.split(".")[1]
+    return os.path.join(output_path,output_file)
+
+
+def _convert_one(path:str,output_path:str):
+    _write_grey(path,_rgb2gray(_read_image(path)),output_path)
+
+
+def _write_grey(path:str,grey_image,output_path:str):
+    p=_output_file(path,output_path)
+    if grey_image.dtype == np.uint8:
+        # already uint8, write it as is without imsave's float rescale
+        imageio.imwrite(p,grey_image)
+    else:
+        imsave(p,grey_image)
+
+
+# start of frame markers, the segments that carry the component count
+SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+def _is_grey_jpeg(path:str):
+    """Read the component count from the jpeg frame header, without decoding"""
+    with open(path, "rb") as f:
+        if f.read(2) != b"\xff\xd8":
+            return False
+        while True:
+            segment = f.read(4)
+            if len(segment) < 4 or segment[0] != 0xFF:
+                return False
+            if segment[1] in SOF_MARKERS:
+                # precision, height, width, number of components
+                frame = f.read(6)
+                return len(frame) == 6 and frame[5] == 1
+            f.seek(int.from_bytes(segment[2:], "big") - 2, os.SEEK_CUR)
+
+
+TIFF_SUFFIXES = (".tif", ".tiff")
+TIFF_TILE_ROWS = 512
+
+
+def _tiff_memmap(path:str):
+    """Memory map an uncompressed uint8 rgb tiff, None if it can't be mapped"""
+    if not path.lower().endswith(TIFF_SUFFIXES):
+        return None
+    try:
+        image = tifffile.memmap(path, mode="r")
+    except ValueError:
+        # compressed or otherwise not memory-mappable
+        return None
+    if image.ndim != 3 or image.shape[-1] not in (3, 4) or image.dtype != np.uint8:
+        return None
+    return image
+
+
+def _grey_tiff(path:str,image,output_path:str):
+    """Convert a memory mapped tiff tile by tile into a memory mapped output"""
+    grey = tifffile.memmap(_output_file(path,output_path), shape=image.shape[:2], dtype=np.uint8)
+    for i in range(0, image.shape[0], TIFF_TILE_ROWS):
+        grey[i:i+TIFF_TILE_ROWS] = _rgb2gray_u8(image[i:i+TIFF_TILE_ROWS])
+    grey.flush()
+
 
 def grey_image(input_path:str,output_path:str):
     #params=json.load(open("data/param/parameters.json","r"))
 
-    #images = []
-    for filename in os.listdir(input_path):
-        path = os.path.join(input_path, filename)
-        if os.path.isfile(path):
-            
-            #files.append(filename)
-            grey_image=rgb2gray(imread(path))
-            #print(output_path)
-            output_file=filename.split(".")[0]+"_grey."+filename.split(".")[1]
-            p=os.path.join(output_path,output_file)
-            imsave(p,grey_image)
-            
+    with os.scandir(input_path) as it:
+        paths = [e.path for e in it
+                 if e.is_file(follow_symlinks=False) and not e.name.startswith(".")]
+
+    # large uncompressed tiffs are read and written through memory maps, so
+    # only the tiles in flight are resident instead of the whole image
+    tiffs = {}
+    for path in paths:
+        image = _tiff_memmap(path)
+        if image is not None:
+            tiffs[path] = image
+    paths = [path for path in paths if path not in tiffs]
+
+    # jpegs that are grey already are copied as they are, without a decode
+    copies = [path for path in paths
+              if path.lower().endswith(JPEG_SUFFIXES) and _is_grey_jpeg(path)]
+    paths = [path for path in paths if path not in copies]
+
+    # decode, convert and encode release the GIL, so files overlap across threads
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+        writes = [pool.submit(_grey_tiff, path, image, output_path)
+                  for path, image in tiffs.items()]
+        writes += [pool.submit(shutil.copyfile, path, _output_file(path, output_path))
+                   for path in copies]
+        writes += [pool.submit(_convert_one, path, output_path) for path in paths]
+        for write in writes:
+            write.result()
+
 
 
 